@@ -674,6 +674,18 @@ class PurchaseInvoice(BuyingController):
 		)
 
 		purchase_receipt_doc_map = {}
+		pr_item_account_map = {}
+
+		pr_details = [item.pr_detail for item in self.get("items") if item.get("pr_detail")]
+		if provisional_accounting_for_non_stock_items and pr_details:
+			pr_item_account_map = {
+				d.name: d
+				for d in frappe.get_all(
+					"Purchase Receipt Item",
+					filters={"name": ["in", pr_details]},
+					fields=["name", "expense_account", "provisional_expense_account"],
+				)
+			}
 
 		for item in self.get("items"):
 			if flt(item.base_net_amount):
@@ -809,8 +821,9 @@ class PurchaseInvoice(BuyingController):
 
 					if provisional_accounting_for_non_stock_items:
 						if item.purchase_receipt:
-							provisional_account = frappe.db.get_value(
-								"Purchase Receipt Item", item.pr_detail, "provisional_expense_account"
+							pr_item_accounts = pr_item_account_map.get(item.pr_detail, {})
+							provisional_account = pr_item_accounts.get(
+								"provisional_expense_account"
 							) or self.get_company_default("default_provisional_account")
 							purchase_receipt_doc = purchase_receipt_doc_map.get(item.purchase_receipt)
 
@@ -834,7 +847,12 @@ class PurchaseInvoice(BuyingController):
 							if expense_booked_in_pr:
 								# Intentionally passing purchase invoice item to handle partial billing
 								purchase_receipt_doc.add_provisional_gl_entry(
-									item, gl_entries, self.posting_date, provisional_account, reverse=1
+									item,
+									gl_entries,
+									self.posting_date,
+									provisional_account,
+									reverse=1,
+									expense_account=pr_item_accounts.get("expense_account"),
 								)
 
 					if not self.is_internal_transfer():
@@ -2,8 +2,14 @@
 # License: GNU General Public License v3. See license.txt
 
 
+import frappe
 from frappe.model.document import Document
 
 
 class PurchaseInvoiceItem(Document):
 	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Purchase Invoice Item", ["purchase_receipt", "docstatus", "pr_detail"])
+	frappe.db.add_index("Purchase Invoice Item", ["po_detail", "docstatus", "pr_detail"])
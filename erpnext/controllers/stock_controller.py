@@ -852,6 +852,42 @@ class StockController(AccountsController):
 
 		gl_entries.append(self.get_gl_dict(gl_entry, item=item))
 
+	def add_gl_pair(
+		self,
+		gl_entries,
+		debit_account,
+		credit_account,
+		amount,
+		cost_center,
+		remarks,
+		debit_in_account_currency=None,
+		credit_in_account_currency=None,
+		project=None,
+		item=None,
+	):
+		"""Add a balanced debit and credit GL entry for the same amount"""
+		common_args = dict(
+			gl_entries=gl_entries, cost_center=cost_center, remarks=remarks, project=project, item=item
+		)
+
+		self.add_gl_entry(
+			account=debit_account,
+			debit=amount,
+			credit=0.0,
+			against_account=credit_account,
+			debit_in_account_currency=debit_in_account_currency,
+			**common_args,
+		)
+
+		self.add_gl_entry(
+			account=credit_account,
+			debit=0.0,
+			credit=amount,
+			against_account=debit_account,
+			credit_in_account_currency=credit_in_account_currency,
+			**common_args,
+		)
+
 
 @frappe.whitelist()
 def show_accounting_ledger_preview(company, doctype, docname):
@@ -0,0 +1,5 @@
+from erpnext.accounts.doctype.purchase_invoice_item.purchase_invoice_item import on_doctype_update
+
+
+def execute():
+	on_doctype_update()
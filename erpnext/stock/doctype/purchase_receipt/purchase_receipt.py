@@ -1,13 +1,15 @@
 # Copyright (c) 2015, Frappe Technologies Pvt. Ltd. and Contributors
 # License: GNU General Public License v3. See license.txt
 
+from collections import defaultdict
 
 import frappe
 from frappe import _, throw
 from frappe.desk.notifications import clear_doctype_notifications
 from frappe.model.mapper import get_mapped_doc
+from frappe.query_builder import Case
 from frappe.query_builder.functions import CombineDatetime
-from frappe.utils import cint, flt, getdate, nowdate
+from frappe.utils import cint, flt, getdate, now, nowdate
 from pypika import functions as fn
 
 import erpnext
@@ -24,6 +26,8 @@ form_grid_templates = {"items": "templates/form_grid/item_grid.html"}
 class PurchaseReceipt(BuyingController):
 	def __init__(self, *args, **kwargs):
 		super(PurchaseReceipt, self).__init__(*args, **kwargs)
+		self._cwip_enabled_cache = {}
+		self._cwip_account_cache = {}
 		self.status_updater = [
 			{
 				"target_dt": "Purchase Order Item",
@@ -140,19 +144,33 @@ class PurchaseReceipt(BuyingController):
 		self.reset_default_field_value("set_from_warehouse", "items", "from_warehouse")
 
 	def validate_cwip_accounts(self):
-		for item in self.get("items"):
-			if item.is_fixed_asset and is_cwip_accounting_enabled(item.asset_category):
+		for item in [d for d in self.get("items") if d.is_fixed_asset]:
+			if self.is_cwip_accounting_enabled(item.asset_category):
 				# check cwip accounts before making auto assets
 				# Improves UX by not giving messages of "Assets Created" before throwing error of not finding arbnb account
 				arbnb_account = self.get_company_default("asset_received_but_not_billed")
-				cwip_account = get_asset_account(
-					"capital_work_in_progress_account", asset_category=item.asset_category, company=self.company
-				)
+				cwip_account = self.get_cwip_account(item.asset_category)
 				break
 
+	def is_cwip_accounting_enabled(self, asset_category):
+		if asset_category not in self._cwip_enabled_cache:
+			self._cwip_enabled_cache[asset_category] = is_cwip_accounting_enabled(asset_category)
+
+		return self._cwip_enabled_cache[asset_category]
+
+	def get_cwip_account(self, asset_category=None):
+		# Returns category's cwip account, falls back to company's default cwip account
+		key = (asset_category, self.company)
+		if key not in self._cwip_account_cache:
+			self._cwip_account_cache[key] = get_asset_account(
+				"capital_work_in_progress_account", asset_category=asset_category, company=self.company
+			)
+
+		return self._cwip_account_cache[key]
+
 	def validate_provisional_expense_account(self):
 		provisional_accounting_for_non_stock_items = cint(
-			frappe.db.get_value(
+			frappe.get_cached_value(
 				"Company", self.company, "enable_provisional_accounting_for_non_stock_items"
 			)
 		)
@@ -182,7 +200,7 @@ class PurchaseReceipt(BuyingController):
 		)
 
 		if (
-			cint(frappe.db.get_single_value("Buying Settings", "maintain_same_rate"))
+			cint(frappe.db.get_single_value("Buying Settings", "maintain_same_rate", cache=True))
 			and not self.is_return
 			and not self.is_internal_supplier
 		):
@@ -191,20 +209,28 @@ class PurchaseReceipt(BuyingController):
 			)
 
 	def po_required(self):
-		if frappe.db.get_value("Buying Settings", None, "po_required") == "Yes":
+		if frappe.db.get_single_value("Buying Settings", "po_required", cache=True) == "Yes":
 			for d in self.get("items"):
 				if not d.purchase_order:
 					frappe.throw(_("Purchase Order number required for Item {0}").format(d.item_code))
 
 	def validate_items_quality_inspection(self):
+		qi_names = [item.quality_inspection for item in self.get("items") if item.quality_inspection]
+		if not qi_names:
+			return
+
+		qi_map = {
+			qi.name: qi
+			for qi in frappe.get_all(
+				"Quality Inspection",
+				filters={"name": ["in", qi_names]},
+				fields=["name", "reference_type", "reference_name", "item_code"],
+			)
+		}
+
 		for item in self.get("items"):
 			if item.quality_inspection:
-				qi = frappe.db.get_value(
-					"Quality Inspection",
-					item.quality_inspection,
-					["reference_type", "reference_name", "item_code"],
-					as_dict=True,
-				)
+				qi = qi_map[item.quality_inspection]
 
 				if qi.reference_type != self.doctype or qi.reference_name != self.name:
 					msg = f"""Row #{item.idx}: Please select a valid Quality Inspection with Reference Type
@@ -234,13 +260,15 @@ class PurchaseReceipt(BuyingController):
 
 	# Check for Closed status
 	def check_on_hold_or_closed_status(self):
-		check_list = []
-		for d in self.get("items"):
-			if (
-				d.meta.get_field("purchase_order") and d.purchase_order and d.purchase_order not in check_list
-			):
-				check_list.append(d.purchase_order)
-				check_on_hold_or_closed_status("Purchase Order", d.purchase_order)
+		# dict keeps the row order, so the first closed Purchase Order is reported
+		purchase_orders = dict.fromkeys(
+			d.purchase_order
+			for d in self.get("items")
+			if d.meta.get_field("purchase_order") and d.purchase_order
+		)
+
+		for purchase_order in purchase_orders:
+			check_on_hold_or_closed_status("Purchase Order", purchase_order)
 
 	# on submit
 	def on_submit(self):
@@ -265,29 +293,22 @@ class PurchaseReceipt(BuyingController):
 		self.repost_future_sle_and_gle()
 		self.set_consumed_qty_in_subcontract_order()
 
-	def check_next_docstatus(self):
-		submit_rv = frappe.db.sql(
-			"""select t1.name
-			from `tabPurchase Invoice` t1,`tabPurchase Invoice Item` t2
-			where t1.name = t2.parent and t2.purchase_receipt = %s and t1.docstatus = 1""",
-			(self.name),
+	def get_submitted_purchase_invoice(self):
+		return frappe.db.get_value(
+			"Purchase Invoice Item", {"purchase_receipt": self.name, "docstatus": 1}, "parent"
 		)
-		if submit_rv:
-			frappe.throw(_("Purchase Invoice {0} is already submitted").format(self.submit_rv[0][0]))
+
+	def check_next_docstatus(self):
+		submitted = self.get_submitted_purchase_invoice()
+		if submitted:
+			frappe.throw(_("Purchase Invoice {0} is already submitted").format(submitted))
 
 	def on_cancel(self):
 		super(PurchaseReceipt, self).on_cancel()
 
 		self.check_on_hold_or_closed_status()
 		# Check if Purchase Invoice has been submitted against current Purchase Order
-		submitted = frappe.db.sql(
-			"""select t1.name
-			from `tabPurchase Invoice` t1,`tabPurchase Invoice Item` t2
-			where t1.name = t2.parent and t2.purchase_receipt = %s and t1.docstatus = 1""",
-			self.name,
-		)
-		if submitted:
-			frappe.throw(_("Purchase Invoice {0} is already submitted").format(submitted[0][0]))
+		self.check_next_docstatus()
 
 		self.update_prevdoc_status()
 		self.update_billing_status()
@@ -322,291 +343,314 @@ class PurchaseReceipt(BuyingController):
 			get_purchase_document_details,
 		)
 
-		stock_rbnb = None
+		stock_rbnb = landed_cost_entries = None
 		if erpnext.is_perpetual_inventory_enabled(self.company):
 			stock_rbnb = self.get_company_default("stock_received_but_not_billed")
 			landed_cost_entries = get_item_account_wise_additional_cost(self.name)
 			expenses_included_in_valuation = self.get_company_default("expenses_included_in_valuation")
 
-		warehouse_with_no_account = []
-		stock_items = self.get_stock_items()
-		provisional_accounting_for_non_stock_items = cint(
-			frappe.db.get_value(
-				"Company", self.company, "enable_provisional_accounting_for_non_stock_items"
-			)
+		default_expense_account = self.get_company_default(
+			"default_expense_account", ignore_validation=True
 		)
+		default_cost_center = frappe.get_cached_value("Company", self.company, "cost_center")
+
+		warehouse_with_no_account = set()
+		stock_rows, provisional_rows = self.partition_items_for_gl_entries()
 
 		exchange_rate_map, net_rate_map = get_purchase_document_details(self)
+		stock_value_diff_map = self.get_stock_value_difference_map()
 
-		for d in self.get("items"):
-			if d.item_code in stock_items and flt(d.valuation_rate) and flt(d.qty):
-				if warehouse_account.get(d.warehouse):
-					stock_value_diff = frappe.db.get_value(
-						"Stock Ledger Entry",
-						{
-							"voucher_type": "Purchase Receipt",
-							"voucher_no": self.name,
-							"voucher_detail_no": d.name,
-							"warehouse": d.warehouse,
-							"is_cancelled": 0,
-						},
-						"stock_value_difference",
-					)
+		supplier_warehouse_account = warehouse_account.get(self.supplier_warehouse, {}).get("account")
+		supplier_warehouse_account_currency = warehouse_account.get(self.supplier_warehouse, {}).get(
+			"account_currency"
+		)
+		remarks = self.get("remarks") or _("Accounting Entry for Stock")
 
-					warehouse_account_name = warehouse_account[d.warehouse]["account"]
-					warehouse_account_currency = warehouse_account[d.warehouse]["account_currency"]
-					supplier_warehouse_account = warehouse_account.get(self.supplier_warehouse, {}).get("account")
-					supplier_warehouse_account_currency = warehouse_account.get(self.supplier_warehouse, {}).get(
-						"account_currency"
-					)
-					remarks = self.get("remarks") or _("Accounting Entry for Stock")
-
-					# If PR is sub-contracted and fg item rate is zero
-					# in that case if account for source and target warehouse are same,
-					# then GL entries should not be posted
-					if (
-						flt(stock_value_diff) == flt(d.rm_supp_cost)
-						and warehouse_account.get(self.supplier_warehouse)
-						and warehouse_account_name == supplier_warehouse_account
-					):
-						continue
+		# Resolve the currency of every account the item loop can credit, once per account
+		accounts = {stock_rbnb}
+		for d in stock_rows:
+			if d.from_warehouse and warehouse_account.get(d.from_warehouse):
+				accounts.add(warehouse_account[d.from_warehouse]["account"])
+
+		if landed_cost_entries:
+			for account_wise_cost in landed_cost_entries.values():
+				accounts.update(account_wise_cost)
+
+		account_currency_map = {
+			account: get_account_currency(account) for account in accounts if account
+		}
+
+		is_internal_transfer = self.is_internal_transfer()
+		conversion_rate = self.conversion_rate
+		company_currency = self.company_currency
+
+		for d in stock_rows:
+			if warehouse_account.get(d.warehouse):
+				stock_value_diff = stock_value_diff_map.get((d.name, d.warehouse), 0)
+
+				warehouse_account_name = warehouse_account[d.warehouse]["account"]
+				warehouse_account_currency = warehouse_account[d.warehouse]["account_currency"]
+
+				# If PR is sub-contracted and fg item rate is zero
+				# in that case if account for source and target warehouse are same,
+				# then GL entries should not be posted
+				if (
+					flt(stock_value_diff) == flt(d.rm_supp_cost)
+					and warehouse_account.get(self.supplier_warehouse)
+					and warehouse_account_name == supplier_warehouse_account
+				):
+					continue
+
+				self.add_gl_entry(
+					gl_entries=gl_entries,
+					account=warehouse_account_name,
+					cost_center=d.cost_center,
+					debit=stock_value_diff,
+					credit=0.0,
+					remarks=remarks,
+					against_account=stock_rbnb,
+					account_currency=warehouse_account_currency,
+					item=d,
+				)
+
+				# GL Entry for from warehouse or Stock Received but not billed
+				# Intentionally passed negative debit amount to avoid incorrect GL Entry validation
+				credit_currency = (
+					account_currency_map.get(warehouse_account[d.from_warehouse]["account"])
+					if d.from_warehouse
+					else account_currency_map.get(stock_rbnb)
+				)
+
+				credit_amount = (
+					flt(d.base_net_amount, d.precision("base_net_amount"))
+					if credit_currency == company_currency
+					else flt(d.net_amount, d.precision("net_amount"))
+				)
+
+				outgoing_amount = d.base_net_amount
+				if is_internal_transfer and d.valuation_rate:
+					outgoing_amount = abs(stock_value_diff_map.get((d.name, d.from_warehouse), 0))
+					credit_amount = outgoing_amount
+
+				if credit_amount:
+					account = warehouse_account[d.from_warehouse]["account"] if d.from_warehouse else stock_rbnb
 
 					self.add_gl_entry(
 						gl_entries=gl_entries,
-						account=warehouse_account_name,
+						account=account,
 						cost_center=d.cost_center,
-						debit=stock_value_diff,
+						debit=-1 * flt(outgoing_amount, d.precision("base_net_amount")),
 						credit=0.0,
 						remarks=remarks,
-						against_account=stock_rbnb,
-						account_currency=warehouse_account_currency,
+						against_account=warehouse_account_name,
+						debit_in_account_currency=-1 * credit_amount,
+						account_currency=credit_currency,
 						item=d,
 					)
 
-					# GL Entry for from warehouse or Stock Received but not billed
-					# Intentionally passed negative debit amount to avoid incorrect GL Entry validation
-					credit_currency = (
-						get_account_currency(warehouse_account[d.from_warehouse]["account"])
-						if d.from_warehouse
-						else get_account_currency(stock_rbnb)
-					)
+					# check if the exchange rate has changed
+					if d.get("purchase_invoice"):
+						invoice_exchange_rate = exchange_rate_map[d.purchase_invoice]
+						exchange_rate_difference = (
+							invoice_exchange_rate - conversion_rate if invoice_exchange_rate else 0
+						)
 
-					credit_amount = (
-						flt(d.base_net_amount, d.precision("base_net_amount"))
-						if credit_currency == self.company_currency
-						else flt(d.net_amount, d.precision("net_amount"))
-					)
+						if exchange_rate_difference and d.net_rate == net_rate_map[d.purchase_invoice_item]:
+							discrepancy_caused_by_exchange_rate_difference = (
+								d.qty * d.net_rate
+							) * exchange_rate_difference
+
+							self.add_gl_entry(
+								gl_entries=gl_entries,
+								account=account,
+								cost_center=d.cost_center,
+								debit=0.0,
+								credit=discrepancy_caused_by_exchange_rate_difference,
+								remarks=remarks,
+								against_account=self.supplier,
+								debit_in_account_currency=-1 * discrepancy_caused_by_exchange_rate_difference,
+								account_currency=credit_currency,
+								item=d,
+							)
 
-					outgoing_amount = d.base_net_amount
-					if self.is_internal_transfer() and d.valuation_rate:
-						outgoing_amount = abs(
-							frappe.db.get_value(
-								"Stock Ledger Entry",
-								{
-									"voucher_type": "Purchase Receipt",
-									"voucher_no": self.name,
-									"voucher_detail_no": d.name,
-									"warehouse": d.from_warehouse,
-									"is_cancelled": 0,
-								},
-								"stock_value_difference",
+							self.add_gl_entry(
+								gl_entries=gl_entries,
+								account=self.get_company_default("exchange_gain_loss_account"),
+								cost_center=d.cost_center,
+								debit=discrepancy_caused_by_exchange_rate_difference,
+								credit=0.0,
+								remarks=remarks,
+								against_account=self.supplier,
+								debit_in_account_currency=-1 * discrepancy_caused_by_exchange_rate_difference,
+								account_currency=credit_currency,
+								item=d,
 							)
-						)
-						credit_amount = outgoing_amount
-
-					if credit_amount:
-						account = warehouse_account[d.from_warehouse]["account"] if d.from_warehouse else stock_rbnb
-
-						self.add_gl_entry(
-							gl_entries=gl_entries,
-							account=account,
-							cost_center=d.cost_center,
-							debit=-1 * flt(outgoing_amount, d.precision("base_net_amount")),
-							credit=0.0,
-							remarks=remarks,
-							against_account=warehouse_account_name,
-							debit_in_account_currency=-1 * credit_amount,
-							account_currency=credit_currency,
-							item=d,
-						)
 
-						# check if the exchange rate has changed
-						if d.get("purchase_invoice"):
-							if (
-								exchange_rate_map[d.purchase_invoice]
-								and self.conversion_rate != exchange_rate_map[d.purchase_invoice]
-								and d.net_rate == net_rate_map[d.purchase_invoice_item]
-							):
-
-								discrepancy_caused_by_exchange_rate_difference = (d.qty * d.net_rate) * (
-									exchange_rate_map[d.purchase_invoice] - self.conversion_rate
-								)
-
-								self.add_gl_entry(
-									gl_entries=gl_entries,
-									account=account,
-									cost_center=d.cost_center,
-									debit=0.0,
-									credit=discrepancy_caused_by_exchange_rate_difference,
-									remarks=remarks,
-									against_account=self.supplier,
-									debit_in_account_currency=-1 * discrepancy_caused_by_exchange_rate_difference,
-									account_currency=credit_currency,
-									item=d,
-								)
-
-								self.add_gl_entry(
-									gl_entries=gl_entries,
-									account=self.get_company_default("exchange_gain_loss_account"),
-									cost_center=d.cost_center,
-									debit=discrepancy_caused_by_exchange_rate_difference,
-									credit=0.0,
-									remarks=remarks,
-									against_account=self.supplier,
-									debit_in_account_currency=-1 * discrepancy_caused_by_exchange_rate_difference,
-									account_currency=credit_currency,
-									item=d,
-								)
-
-					# Amount added through landed-cos-voucher
-					if d.landed_cost_voucher_amount and landed_cost_entries:
-						if (d.item_code, d.name) in landed_cost_entries:
-							for account, amount in landed_cost_entries[(d.item_code, d.name)].items():
-								account_currency = get_account_currency(account)
-								credit_amount = (
-									flt(amount["base_amount"])
-									if (amount["base_amount"] or account_currency != self.company_currency)
-									else flt(amount["amount"])
-								)
-
-								self.add_gl_entry(
-									gl_entries=gl_entries,
-									account=account,
-									cost_center=d.cost_center,
-									debit=0.0,
-									credit=credit_amount,
-									remarks=remarks,
-									against_account=warehouse_account_name,
-									credit_in_account_currency=flt(amount["amount"]),
-									account_currency=account_currency,
-									project=d.project,
-									item=d,
-								)
-
-					if d.rate_difference_with_purchase_invoice and stock_rbnb:
-						account_currency = get_account_currency(stock_rbnb)
-						self.add_gl_entry(
-							gl_entries=gl_entries,
-							account=stock_rbnb,
-							cost_center=d.cost_center,
-							debit=0.0,
-							credit=flt(d.rate_difference_with_purchase_invoice),
-							remarks=_("Adjustment based on Purchase Invoice rate"),
-							against_account=warehouse_account_name,
-							account_currency=account_currency,
-							project=d.project,
-							item=d,
-						)
+				# Amount added through landed-cos-voucher
+				if d.landed_cost_voucher_amount and landed_cost_entries:
+					if (d.item_code, d.name) in landed_cost_entries:
+						for account, amount in landed_cost_entries[(d.item_code, d.name)].items():
+							account_currency = account_currency_map.get(account)
+							credit_amount = (
+								flt(amount["base_amount"])
+								if (amount["base_amount"] or account_currency != company_currency)
+								else flt(amount["amount"])
+							)
 
-					# sub-contracting warehouse
-					if flt(d.rm_supp_cost) and warehouse_account.get(self.supplier_warehouse):
-						self.add_gl_entry(
-							gl_entries=gl_entries,
-							account=supplier_warehouse_account,
-							cost_center=d.cost_center,
-							debit=0.0,
-							credit=flt(d.rm_supp_cost),
-							remarks=remarks,
-							against_account=warehouse_account_name,
-							account_currency=supplier_warehouse_account_currency,
-							item=d,
-						)
+							self.add_gl_entry(
+								gl_entries=gl_entries,
+								account=account,
+								cost_center=d.cost_center,
+								debit=0.0,
+								credit=credit_amount,
+								remarks=remarks,
+								against_account=warehouse_account_name,
+								credit_in_account_currency=flt(amount["amount"]),
+								account_currency=account_currency,
+								project=d.project,
+								item=d,
+							)
 
-					# divisional loss adjustment
-					valuation_amount_as_per_doc = (
-						flt(outgoing_amount, d.precision("base_net_amount"))
-						+ flt(d.landed_cost_voucher_amount)
-						+ flt(d.rm_supp_cost)
-						+ flt(d.item_tax_amount)
-						+ flt(d.rate_difference_with_purchase_invoice)
+				if d.rate_difference_with_purchase_invoice and stock_rbnb:
+					account_currency = account_currency_map.get(stock_rbnb)
+					self.add_gl_entry(
+						gl_entries=gl_entries,
+						account=stock_rbnb,
+						cost_center=d.cost_center,
+						debit=0.0,
+						credit=flt(d.rate_difference_with_purchase_invoice),
+						remarks=_("Adjustment based on Purchase Invoice rate"),
+						against_account=warehouse_account_name,
+						account_currency=account_currency,
+						project=d.project,
+						item=d,
 					)
 
-					divisional_loss = flt(
-						valuation_amount_as_per_doc - flt(stock_value_diff), d.precision("base_net_amount")
+				# sub-contracting warehouse
+				if flt(d.rm_supp_cost) and warehouse_account.get(self.supplier_warehouse):
+					self.add_gl_entry(
+						gl_entries=gl_entries,
+						account=supplier_warehouse_account,
+						cost_center=d.cost_center,
+						debit=0.0,
+						credit=flt(d.rm_supp_cost),
+						remarks=remarks,
+						against_account=warehouse_account_name,
+						account_currency=supplier_warehouse_account_currency,
+						item=d,
 					)
 
-					if divisional_loss:
-						if self.is_return or flt(d.item_tax_amount):
-							loss_account = expenses_included_in_valuation
-						else:
-							loss_account = (
-								self.get_company_default("default_expense_account", ignore_validation=True) or stock_rbnb
-							)
+				# divisional loss adjustment
+				valuation_amount_as_per_doc = (
+					flt(outgoing_amount, d.precision("base_net_amount"))
+					+ flt(d.landed_cost_voucher_amount)
+					+ flt(d.rm_supp_cost)
+					+ flt(d.item_tax_amount)
+					+ flt(d.rate_difference_with_purchase_invoice)
+				)
 
-						cost_center = d.cost_center or frappe.get_cached_value(
-							"Company", self.company, "cost_center"
-						)
+				divisional_loss = flt(
+					valuation_amount_as_per_doc - flt(stock_value_diff), d.precision("base_net_amount")
+				)
 
-						self.add_gl_entry(
-							gl_entries=gl_entries,
-							account=loss_account,
-							cost_center=cost_center,
-							debit=divisional_loss,
-							credit=0.0,
-							remarks=remarks,
-							against_account=warehouse_account_name,
-							account_currency=credit_currency,
-							project=d.project,
-							item=d,
-						)
+				if divisional_loss:
+					if self.is_return or flt(d.item_tax_amount):
+						loss_account = expenses_included_in_valuation
+					else:
+						loss_account = default_expense_account or stock_rbnb
 
-				elif (
-					d.warehouse not in warehouse_with_no_account
-					or d.rejected_warehouse not in warehouse_with_no_account
-				):
-					warehouse_with_no_account.append(d.warehouse)
+					cost_center = d.cost_center or default_cost_center
+
+					self.add_gl_entry(
+						gl_entries=gl_entries,
+						account=loss_account,
+						cost_center=cost_center,
+						debit=divisional_loss,
+						credit=0.0,
+						remarks=remarks,
+						against_account=warehouse_account_name,
+						account_currency=credit_currency,
+						project=d.project,
+						item=d,
+					)
+
+			else:
+				warehouse_with_no_account.add(d.warehouse)
+				if d.rejected_warehouse and not warehouse_account.get(d.rejected_warehouse):
+					warehouse_with_no_account.add(d.rejected_warehouse)
+
+		for d in provisional_rows:
+			self.add_provisional_gl_entry(
+				d, gl_entries, self.posting_date, d.get("provisional_expense_account")
+			)
+
+		if warehouse_with_no_account:
+			frappe.msgprint(
+				_("No accounting entries for the following warehouses")
+				+ ": \n"
+				+ "\n".join(sorted(warehouse_with_no_account))
+			)
+
+	def partition_items_for_gl_entries(self):
+		"""Split rows into those posting stock entries and those posting provisional entries"""
+		stock_items = frozenset(self.get_stock_items())
+		provisional_accounting_for_non_stock_items = cint(
+			frappe.get_cached_value(
+				"Company", self.company, "enable_provisional_accounting_for_non_stock_items"
+			)
+		)
+
+		stock_rows, provisional_rows = [], []
+		for d in self.get("items"):
+			if d.item_code in stock_items:
+				if flt(d.valuation_rate) and flt(d.qty):
+					stock_rows.append(d)
 			elif (
-				d.item_code not in stock_items
-				and not d.is_fixed_asset
+				not d.is_fixed_asset
 				and flt(d.qty)
 				and provisional_accounting_for_non_stock_items
 				and d.get("provisional_expense_account")
 			):
-				self.add_provisional_gl_entry(
-					d, gl_entries, self.posting_date, d.get("provisional_expense_account")
-				)
+				provisional_rows.append(d)
 
-		if warehouse_with_no_account:
-			frappe.msgprint(
-				_("No accounting entries for the following warehouses")
-				+ ": \n"
-				+ "\n".join(warehouse_with_no_account)
+		return stock_rows, provisional_rows
+
+	def get_stock_value_difference_map(self):
+		"""returns a map: {(voucher_detail_no, warehouse): stock_value_difference}"""
+		stock_value_diff_map = {}
+
+		for sle in frappe.get_all(
+			"Stock Ledger Entry",
+			filters={"voucher_type": "Purchase Receipt", "voucher_no": self.name, "is_cancelled": 0},
+			fields=["voucher_detail_no", "warehouse", "stock_value_difference"],
+		):
+			stock_value_diff_map.setdefault(
+				(sle.voucher_detail_no, sle.warehouse), sle.stock_value_difference
 			)
 
+		return stock_value_diff_map
+
 	def add_provisional_gl_entry(
-		self, item, gl_entries, posting_date, provisional_account, reverse=0
+		self, item, gl_entries, posting_date, provisional_account, reverse=0, expense_account=None
 	):
-		credit_currency = get_account_currency(provisional_account)
-		debit_currency = get_account_currency(item.expense_account)
-		expense_account = item.expense_account
-		remarks = self.get("remarks") or _("Accounting Entry for Service")
 		multiplication_factor = 1
 
 		if reverse:
 			multiplication_factor = -1
-			expense_account = frappe.db.get_value(
-				"Purchase Receipt Item", {"name": item.get("pr_detail")}, ["expense_account"]
-			)
+			# Reverse entries are booked against the Purchase Receipt Item's expense account,
+			# callers posting several rows can pass it in to avoid a lookup per row
+			if not expense_account:
+				expense_account = frappe.db.get_value(
+					"Purchase Receipt Item", {"name": item.get("pr_detail")}, ["expense_account"]
+				)
+		else:
+			expense_account = item.expense_account
 
-		self.add_gl_entry(
+		amount = multiplication_factor * item.amount
+		common_args = dict(
 			gl_entries=gl_entries,
-			account=provisional_account,
 			cost_center=item.cost_center,
-			debit=0.0,
-			credit=multiplication_factor * item.amount,
-			remarks=remarks,
-			against_account=expense_account,
-			account_currency=credit_currency,
+			remarks=self.get("remarks") or _("Accounting Entry for Service"),
 			project=item.project,
 			voucher_detail_no=item.name,
 			item=item,
@@ -614,18 +658,21 @@ class PurchaseReceipt(BuyingController):
 		)
 
 		self.add_gl_entry(
-			gl_entries=gl_entries,
+			account=provisional_account,
+			debit=0.0,
+			credit=amount,
+			against_account=expense_account,
+			account_currency=get_account_currency(provisional_account),
+			**common_args,
+		)
+
+		self.add_gl_entry(
 			account=expense_account,
-			cost_center=item.cost_center,
-			debit=multiplication_factor * item.amount,
+			debit=amount,
 			credit=0.0,
-			remarks=remarks,
 			against_account=provisional_account,
-			account_currency=debit_currency,
-			project=item.project,
-			voucher_detail_no=item.name,
-			item=item,
-			posting_date=posting_date,
+			account_currency=get_account_currency(expense_account),
+			**common_args,
 		)
 
 	def make_tax_gl_entries(self, gl_entries):
@@ -633,24 +680,26 @@ class PurchaseReceipt(BuyingController):
 		if erpnext.is_perpetual_inventory_enabled(self.company):
 			expenses_included_in_valuation = self.get_company_default("expenses_included_in_valuation")
 
-		negative_expense_to_be_booked = sum([flt(d.item_tax_amount) for d in self.get("items")])
+		negative_expense_to_be_booked = sum(flt(d.item_tax_amount) for d in self.get("items"))
 		# Cost center-wise amount breakup for other charges included for valuation
 		valuation_tax = {}
+		total_valuation_amount = 0.0
 		for tax in self.get("taxes"):
-			if tax.category in ("Valuation", "Valuation and Total") and flt(
-				tax.base_tax_amount_after_discount_amount
-			):
-				if not tax.cost_center:
-					frappe.throw(
-						_("Cost Center is required in row {0} in Taxes table for type {1}").format(
-							tax.idx, _(tax.category)
-						)
+			tax_amount = flt(tax.base_tax_amount_after_discount_amount)
+			if not tax_amount or tax.category not in ("Valuation", "Valuation and Total"):
+				continue
+
+			if not tax.cost_center:
+				frappe.throw(
+					_("Cost Center is required in row {0} in Taxes table for type {1}").format(
+						tax.idx, _(tax.category)
 					)
-				valuation_tax.setdefault(tax.name, 0)
-				valuation_tax[tax.name] += (tax.add_deduct_tax == "Add" and 1 or -1) * flt(
-					tax.base_tax_amount_after_discount_amount
 				)
 
+			tax_amount *= tax.add_deduct_tax == "Add" and 1 or -1
+			valuation_tax[tax.name] = valuation_tax.get(tax.name, 0) + tax_amount
+			total_valuation_amount += tax_amount
+
 		if negative_expense_to_be_booked and valuation_tax:
 			# Backward compatibility:
 			# If expenses_included_in_valuation account has been credited in against PI
@@ -667,95 +716,77 @@ class PurchaseReceipt(BuyingController):
 			)
 
 			against_account = ", ".join([d.account for d in gl_entries if flt(d.debit) > 0])
-			total_valuation_amount = sum(valuation_tax.values())
-			amount_including_divisional_loss = negative_expense_to_be_booked
 			stock_rbnb = self.get_company_default("stock_received_but_not_billed")
-			i = 1
-			for tax in self.get("taxes"):
-				if valuation_tax.get(tax.name):
+			account_override = stock_rbnb if negative_expense_booked_in_pi else None
+			remarks = self.remarks or _("Accounting Entry for Stock")
 
-					if negative_expense_booked_in_pi:
-						account = stock_rbnb
-					else:
-						account = tax.account_head
+			taxes_with_valuation = [tax for tax in self.get("taxes") if valuation_tax.get(tax.name)]
 
-					if i == len(valuation_tax):
-						applicable_amount = amount_including_divisional_loss
-					else:
-						applicable_amount = negative_expense_to_be_booked * (
-							valuation_tax[tax.name] / total_valuation_amount
-						)
-						amount_including_divisional_loss -= applicable_amount
-
-					self.add_gl_entry(
-						gl_entries=gl_entries,
-						account=account,
-						cost_center=tax.cost_center,
-						debit=0.0,
-						credit=applicable_amount,
-						remarks=self.remarks or _("Accounting Entry for Stock"),
-						against_account=against_account,
-						item=tax,
-					)
-
-					i += 1
+			# Distribute the expense proportionally, the last row takes the divisional loss
+			applicable_amounts = []
+			amount_including_divisional_loss = negative_expense_to_be_booked
+			for tax in taxes_with_valuation[:-1]:
+				applicable_amount = negative_expense_to_be_booked * (
+					valuation_tax[tax.name] / total_valuation_amount
+				)
+				amount_including_divisional_loss -= applicable_amount
+				applicable_amounts.append(applicable_amount)
+			applicable_amounts.append(amount_including_divisional_loss)
+
+			for tax, applicable_amount in zip(taxes_with_valuation, applicable_amounts):
+				self.add_gl_entry(
+					gl_entries=gl_entries,
+					account=account_override or tax.account_head,
+					cost_center=tax.cost_center,
+					debit=0.0,
+					credit=applicable_amount,
+					remarks=remarks,
+					against_account=against_account,
+					item=tax,
+				)
 
 	def get_asset_gl_entry(self, gl_entries):
-		for item in self.get("items"):
-			if item.is_fixed_asset:
-				if is_cwip_accounting_enabled(item.asset_category):
-					self.add_asset_gl_entries(item, gl_entries)
-				if flt(item.landed_cost_voucher_amount):
-					self.add_lcv_gl_entries(item, gl_entries)
-					# update assets gross amount by its valuation rate
-					# valuation rate is total of net rate, raw mat supp cost, tax amount, lcv amount per item
-					self.update_assets(item, item.valuation_rate)
+		arbnb_account = arbnb_account_currency = None
+		for item in [d for d in self.get("items") if d.is_fixed_asset]:
+			if self.is_cwip_accounting_enabled(item.asset_category):
+				if not arbnb_account:
+					arbnb_account = self.get_company_default("asset_received_but_not_billed")
+					arbnb_account_currency = get_account_currency(arbnb_account)
+
+				self.add_asset_gl_entries(item, gl_entries, arbnb_account, arbnb_account_currency)
+			if flt(item.landed_cost_voucher_amount):
+				self.add_lcv_gl_entries(item, gl_entries)
+				# update assets gross amount by its valuation rate
+				# valuation rate is total of net rate, raw mat supp cost, tax amount, lcv amount per item
+				self.update_assets(item, item.valuation_rate)
 		return gl_entries
 
-	def add_asset_gl_entries(self, item, gl_entries):
-		arbnb_account = self.get_company_default("asset_received_but_not_billed")
+	def add_asset_gl_entries(self, item, gl_entries, arbnb_account=None, arbnb_account_currency=None):
+		if not arbnb_account:
+			arbnb_account = self.get_company_default("asset_received_but_not_billed")
+			arbnb_account_currency = get_account_currency(arbnb_account)
+
 		# This returns category's cwip account if not then fallback to company's default cwip account
-		cwip_account = get_asset_account(
-			"capital_work_in_progress_account", asset_category=item.asset_category, company=self.company
-		)
+		cwip_account = self.get_cwip_account(item.asset_category)
+		cwip_account_currency = get_account_currency(cwip_account)
 
 		asset_amount = flt(item.net_amount) + flt(item.item_tax_amount / self.conversion_rate)
 		base_asset_amount = flt(item.base_net_amount + item.item_tax_amount)
-		remarks = self.get("remarks") or _("Accounting Entry for Asset")
 
-		cwip_account_currency = get_account_currency(cwip_account)
-		# debit cwip account
-		debit_in_account_currency = (
-			base_asset_amount if cwip_account_currency == self.company_currency else asset_amount
-		)
-
-		self.add_gl_entry(
-			gl_entries=gl_entries,
-			account=cwip_account,
-			cost_center=item.cost_center,
-			debit=base_asset_amount,
-			credit=0.0,
-			remarks=remarks,
-			against_account=arbnb_account,
-			debit_in_account_currency=debit_in_account_currency,
-			item=item,
-		)
-
-		asset_rbnb_currency = get_account_currency(arbnb_account)
-		# credit arbnb account
-		credit_in_account_currency = (
-			base_asset_amount if asset_rbnb_currency == self.company_currency else asset_amount
-		)
-
-		self.add_gl_entry(
+		# debit cwip account, credit arbnb account
+		self.add_gl_pair(
 			gl_entries=gl_entries,
-			account=arbnb_account,
+			debit_account=cwip_account,
+			credit_account=arbnb_account,
+			amount=base_asset_amount,
 			cost_center=item.cost_center,
-			debit=0.0,
-			credit=base_asset_amount,
-			remarks=remarks,
-			against_account=cwip_account,
-			credit_in_account_currency=credit_in_account_currency,
+			remarks=self.get("remarks") or _("Accounting Entry for Asset"),
+			debit_in_account_currency=(
+				base_asset_amount if cwip_account_currency == self.company_currency else asset_amount
+			),
+			credit_in_account_currency=(
+				base_asset_amount if arbnb_account_currency == self.company_currency else asset_amount
+			),
 			item=item,
 		)
 
@@ -763,48 +794,32 @@ class PurchaseReceipt(BuyingController):
 		expenses_included_in_asset_valuation = self.get_company_default(
 			"expenses_included_in_asset_valuation"
 		)
-		if not is_cwip_accounting_enabled(item.asset_category):
+		if not self.is_cwip_accounting_enabled(item.asset_category):
 			asset_account = get_asset_category_account(
 				asset_category=item.asset_category, fieldname="fixed_asset_account", company=self.company
 			)
 		else:
 			# This returns company's default cwip account
-			asset_account = get_asset_account("capital_work_in_progress_account", company=self.company)
-
-		remarks = self.get("remarks") or _("Accounting Entry for Stock")
-
-		self.add_gl_entry(
-			gl_entries=gl_entries,
-			account=expenses_included_in_asset_valuation,
-			cost_center=item.cost_center,
-			debit=0.0,
-			credit=flt(item.landed_cost_voucher_amount),
-			remarks=remarks,
-			against_account=asset_account,
-			project=item.project,
-			item=item,
-		)
+			asset_account = self.get_cwip_account()
 
-		self.add_gl_entry(
+		self.add_gl_pair(
 			gl_entries=gl_entries,
-			account=asset_account,
+			debit_account=asset_account,
+			credit_account=expenses_included_in_asset_valuation,
+			amount=flt(item.landed_cost_voucher_amount),
 			cost_center=item.cost_center,
-			debit=flt(item.landed_cost_voucher_amount),
-			credit=0.0,
-			remarks=remarks,
-			against_account=expenses_included_in_asset_valuation,
+			remarks=self.get("remarks") or _("Accounting Entry for Stock"),
 			project=item.project,
 			item=item,
 		)
 
 	def update_assets(self, item, valuation_rate):
-		assets = frappe.db.get_all(
-			"Asset", filters={"purchase_receipt": self.name, "item_code": item.item_code}
-		)
-
-		for asset in assets:
-			frappe.db.set_value("Asset", asset.name, "gross_purchase_amount", flt(valuation_rate))
-			frappe.db.set_value("Asset", asset.name, "purchase_receipt_amount", flt(valuation_rate))
+		asset = frappe.qb.DocType("Asset")
+		frappe.qb.update(asset).set(asset.gross_purchase_amount, flt(valuation_rate)).set(
+			asset.purchase_receipt_amount, flt(valuation_rate)
+		).set(asset.modified, now()).set(asset.modified_by, frappe.session.user).where(
+			(asset.purchase_receipt == self.name) & (asset.item_code == item.item_code)
+		).run()
 
 	def update_status(self, status):
 		self.set_status(update=True, status=status)
@@ -824,27 +839,43 @@ class PurchaseReceipt(BuyingController):
 			updated_pr += update_billed_amount_based_on_po(po_details, update_modified)
 
 		for pr in set(updated_pr):
-			pr_doc = self if (pr == self.name) else frappe.get_doc("Purchase Receipt", pr)
+			if pr == self.name:
+				# Billed amount was set in db directly, refresh only that instead of reloading the doc
+				self.reload_billed_amount()
+				pr_doc = self
+			else:
+				pr_doc = frappe.get_doc("Purchase Receipt", pr)
+
 			update_billing_percentage(pr_doc, update_modified=update_modified)
 
-		self.load_from_db()
+	def reload_billed_amount(self):
+		billed_amt_map = frappe._dict(
+			frappe.get_all(
+				"Purchase Receipt Item",
+				filters={"parent": self.name},
+				fields=["name", "billed_amt"],
+				as_list=1,
+			)
+		)
+
+		for d in self.get("items"):
+			d.billed_amt = flt(billed_amt_map.get(d.name))
 
 
 def update_billed_amount_based_on_po(po_details, update_modified=True):
 	po_billed_amt_details = get_billed_amount_against_po(po_details)
 
 	# Get all Purchase Receipt Item rows against the Purchase Order Items
+	# along with the amount billed directly against each of them
 	pr_details = get_purchase_receipts_against_po_details(po_details)
 
-	pr_items = [pr_detail.name for pr_detail in pr_details]
-	pr_items_billed_amount = get_billed_amount_against_pr(pr_items)
-
 	updated_pr = []
+	billed_amt_to_update = {}
 	for pr_item in pr_details:
 		billed_against_po = flt(po_billed_amt_details.get(pr_item.purchase_order_item))
 
 		# Get billed amount directly against Purchase Receipt
-		billed_amt_agianst_pr = flt(pr_items_billed_amount.get(pr_item.name, 0))
+		billed_amt_agianst_pr = flt(pr_item.billed_amt_against_pr)
 
 		# Distribute billed amount directly against PO between PRs based on FIFO
 		if billed_against_po and billed_amt_agianst_pr < pr_item.amount:
@@ -859,41 +890,83 @@ def update_billed_amount_based_on_po(po_details, update_modified=True):
 		po_billed_amt_details[pr_item.purchase_order_item] = billed_against_po
 
 		if pr_item.billed_amt != billed_amt_agianst_pr:
-			frappe.db.set_value(
-				"Purchase Receipt Item",
-				pr_item.name,
-				"billed_amt",
-				billed_amt_agianst_pr,
-				update_modified=update_modified,
-			)
-
+			billed_amt_to_update[pr_item.name] = {"billed_amt": billed_amt_agianst_pr}
 			updated_pr.append(pr_item.parent)
 
+	set_purchase_receipt_item_values(billed_amt_to_update, update_modified)
+
 	return updated_pr
 
 
+def set_purchase_receipt_item_values(values, update_modified=True):
+	"""Update many Purchase Receipt Item rows in one UPDATE, `values` is {name: {fieldname: value}}"""
+	if not values:
+		return
+
+	purchase_receipt_item = frappe.qb.DocType("Purchase Receipt Item")
+	query = frappe.qb.update(purchase_receipt_item).where(
+		purchase_receipt_item.name.isin(list(values))
+	)
+
+	fieldnames = {fieldname for row_values in values.values() for fieldname in row_values}
+	for fieldname in fieldnames:
+		value_case = Case()
+		for name, row_values in values.items():
+			if fieldname in row_values:
+				value_case = value_case.when(purchase_receipt_item.name == name, row_values[fieldname])
+
+		query = query.set(
+			purchase_receipt_item[fieldname], value_case.else_(purchase_receipt_item[fieldname])
+		)
+
+	if update_modified:
+		query = query.set(purchase_receipt_item.modified, now()).set(
+			purchase_receipt_item.modified_by, frappe.session.user
+		)
+
+	query.run()
+
+
 def get_purchase_receipts_against_po_details(po_details):
-	# Get Purchase Receipts against Purchase Order Items
+	# Get Purchase Receipts against Purchase Order Items,
+	# with the amount billed directly against each Purchase Receipt Item
 
 	purchase_receipt = frappe.qb.DocType("Purchase Receipt")
 	purchase_receipt_item = frappe.qb.DocType("Purchase Receipt Item")
+	purchase_invoice_item = frappe.qb.DocType("Purchase Invoice Item")
 
 	query = (
 		frappe.qb.from_(purchase_receipt)
 		.inner_join(purchase_receipt_item)
 		.on(purchase_receipt.name == purchase_receipt_item.parent)
+		.left_join(purchase_invoice_item)
+		.on(
+			(purchase_invoice_item.pr_detail == purchase_receipt_item.name)
+			& (purchase_invoice_item.docstatus == 1)
+		)
 		.select(
 			purchase_receipt_item.name,
 			purchase_receipt_item.parent,
 			purchase_receipt_item.amount,
 			purchase_receipt_item.billed_amt,
 			purchase_receipt_item.purchase_order_item,
+			fn.Coalesce(fn.Sum(purchase_invoice_item.amount), 0).as_("billed_amt_against_pr"),
 		)
 		.where(
 			(purchase_receipt_item.purchase_order_item.isin(po_details))
 			& (purchase_receipt.docstatus == 1)
 			& (purchase_receipt.is_return == 0)
 		)
+		.groupby(
+			purchase_receipt_item.name,
+			purchase_receipt_item.parent,
+			purchase_receipt_item.amount,
+			purchase_receipt_item.billed_amt,
+			purchase_receipt_item.purchase_order_item,
+			purchase_receipt.posting_date,
+			purchase_receipt.posting_time,
+			purchase_receipt.name,
+		)
 		.orderby(CombineDatetime(purchase_receipt.posting_date, purchase_receipt.posting_time))
 		.orderby(purchase_receipt.name)
 	)
@@ -901,24 +974,6 @@ def get_purchase_receipts_against_po_details(po_details):
 	return query.run(as_dict=True)
 
 
-def get_billed_amount_against_pr(pr_items):
-	# Get billed amount directly against Purchase Receipt
-
-	if not pr_items:
-		return {}
-
-	purchase_invoice_item = frappe.qb.DocType("Purchase Invoice Item")
-
-	query = (
-		frappe.qb.from_(purchase_invoice_item)
-		.select(fn.Sum(purchase_invoice_item.amount).as_("billed_amt"), purchase_invoice_item.pr_detail)
-		.where((purchase_invoice_item.pr_detail.isin(pr_items)) & (purchase_invoice_item.docstatus == 1))
-		.groupby(purchase_invoice_item.pr_detail)
-	).run(as_dict=1)
-
-	return {d.pr_detail: flt(d.billed_amt) for d in query}
-
-
 def get_billed_amount_against_po(po_items):
 	# Get billed amount directly against Purchase Order
 	if not po_items:
@@ -937,49 +992,106 @@ def get_billed_amount_against_po(po_items):
 		.groupby(purchase_invoice_item.po_detail)
 	).run(as_dict=1)
 
-	return {d.po_detail: flt(d.billed_amt) for d in query}
+	return {d.po_detail: float(d.billed_amt or 0) for d in query}
 
 
 def update_billing_percentage(pr_doc, update_modified=True, adjust_incoming_rate=False):
-	# Reload as billed amount was set in db directly
-	pr_doc.load_from_db()
+	# pr_doc is expected to be freshly loaded, as billed amount is set in db directly
 
 	# Update Billing % based on pending accepted qty
+	if adjust_incoming_rate:
+		total_amount, total_billed_amount = adjust_rate_difference_and_get_billing_totals(pr_doc)
+	else:
+		total_amount, total_billed_amount = get_billing_totals(pr_doc.name)
+
+	percent_billed = round(100 * (total_billed_amount / (total_amount or 1)), 6)
+	# db_set also updates per_billed in memory, the items are already current
+	pr_doc.db_set("per_billed", percent_billed)
+
+	if update_modified:
+		pr_doc.set_status(update=True)
+		pr_doc.notify_update()
+
+	if adjust_incoming_rate:
+		adjust_incoming_rate_for_pr(pr_doc)
+
+
+def get_billing_totals(purchase_receipt):
+	"""returns (billable amount, billed amount) of a Purchase Receipt, net of returns"""
+	# Same max(billed, amount - returned amount) rule as
+	# adjust_rate_difference_and_get_billing_totals, keep the two in sync
+	totals = frappe.db.sql(
+		"""
+		select
+			sum(case
+				when pr_item.billed_amt <= pr_item.amount - coalesce(returned.qty, 0) * pr_item.rate
+				then pr_item.amount - coalesce(returned.qty, 0) * pr_item.rate
+				else pr_item.billed_amt
+			end),
+			sum(pr_item.billed_amt)
+		from `tabPurchase Receipt Item` pr_item
+		left join (
+			select return_item.purchase_receipt_item, sum(abs(return_item.qty)) as qty
+			from `tabPurchase Receipt Item` return_item
+			inner join `tabPurchase Receipt` return_doc on return_doc.name = return_item.parent
+			where return_doc.return_against = %(purchase_receipt)s
+				and return_doc.is_return = 1
+				and return_doc.docstatus = 1
+			group by return_item.purchase_receipt_item
+		) returned on returned.purchase_receipt_item = pr_item.name
+		where pr_item.parent = %(purchase_receipt)s and pr_item.parenttype = 'Purchase Receipt'
+	""",
+		{"purchase_receipt": purchase_receipt},
+	)
+
+	return flt(totals[0][0]), flt(totals[0][1])
+
+
+def adjust_rate_difference_and_get_billing_totals(pr_doc):
+	"""Sets the rate difference of each item against its billed amount
+	and returns (billable amount, billed amount) of the Purchase Receipt"""
 	total_amount, total_billed_amount = 0, 0
 	item_wise_returned_qty = get_item_wise_returned_qty(pr_doc)
+	rate_difference_to_update = {}
 
 	for item in pr_doc.items:
 		returned_qty = flt(item_wise_returned_qty.get(item.name))
 		returned_amount = flt(returned_qty) * flt(item.rate)
 		pending_amount = flt(item.amount) - returned_amount
+		# Same rule as the SQL in get_billing_totals, keep the two in sync
 		total_billable_amount = pending_amount if item.billed_amt <= pending_amount else item.billed_amt
 
 		total_amount += total_billable_amount
 		total_billed_amount += flt(item.billed_amt)
-		if adjust_incoming_rate:
-			adjusted_amt = 0.0
-			if item.billed_amt and item.amount:
-				adjusted_amt = flt(item.billed_amt) - flt(item.amount)
 
-			item.db_set("rate_difference_with_purchase_invoice", adjusted_amt, update_modified=False)
+		adjusted_amt = 0.0
+		if item.billed_amt and item.amount:
+			adjusted_amt = flt(item.billed_amt) - flt(item.amount)
 
-	percent_billed = round(100 * (total_billed_amount / (total_amount or 1)), 6)
-	pr_doc.db_set("per_billed", percent_billed)
-	pr_doc.load_from_db()
+		item.rate_difference_with_purchase_invoice = adjusted_amt
+		rate_difference_to_update[item.name] = {"rate_difference_with_purchase_invoice": adjusted_amt}
 
-	if update_modified:
-		pr_doc.set_status(update=True)
-		pr_doc.notify_update()
+	set_purchase_receipt_item_values(rate_difference_to_update, update_modified=False)
 
-	if adjust_incoming_rate:
-		adjust_incoming_rate_for_pr(pr_doc)
+	return total_amount, total_billed_amount
 
 
 def adjust_incoming_rate_for_pr(doc):
 	doc.update_valuation_rate(reset_outgoing_rate=False)
 
-	for item in doc.get("items"):
-		item.db_update()
+	# Only the fields recomputed by update_valuation_rate need to be written back
+	set_purchase_receipt_item_values(
+		{
+			item.name: {
+				"valuation_rate": item.valuation_rate,
+				"item_tax_amount": item.item_tax_amount,
+				"rm_supp_cost": item.rm_supp_cost,
+				"conversion_factor": item.conversion_factor,
+			}
+			for item in doc.get("items")
+		},
+		update_modified=False,
+	)
 
 	doc.docstatus = 2
 	doc.update_stock_ledger(allow_negative_stock=True, via_landed_cost_voucher=True)
@@ -994,62 +1106,83 @@ def adjust_incoming_rate_for_pr(doc):
 
 def get_item_wise_returned_qty(pr_doc):
 	items = [d.name for d in pr_doc.items]
+	if not items:
+		return frappe._dict()
 
-	return frappe._dict(
-		frappe.get_all(
-			"Purchase Receipt",
-			fields=[
-				"`tabPurchase Receipt Item`.purchase_receipt_item",
-				"sum(abs(`tabPurchase Receipt Item`.qty)) as qty",
-			],
-			filters=[
-				["Purchase Receipt", "docstatus", "=", 1],
-				["Purchase Receipt", "is_return", "=", 1],
-				["Purchase Receipt Item", "purchase_receipt_item", "in", items],
-			],
-			group_by="`tabPurchase Receipt Item`.purchase_receipt_item",
-			as_list=1,
+	# Most receipts have no returns, skip the aggregation for them
+	if not frappe.db.exists(
+		"Purchase Receipt",
+		{
+			"supplier": pr_doc.supplier,
+			"is_return": 1,
+			"return_against": pr_doc.name,
+			"docstatus": 1,
+		},
+	):
+		return frappe._dict()
+
+	purchase_receipt = frappe.qb.DocType("Purchase Receipt")
+	purchase_receipt_item = frappe.qb.DocType("Purchase Receipt Item")
+
+	query = (
+		frappe.qb.from_(purchase_receipt_item)
+		.inner_join(purchase_receipt)
+		.on(purchase_receipt_item.parent == purchase_receipt.name)
+		.select(purchase_receipt_item.purchase_receipt_item, fn.Sum(fn.Abs(purchase_receipt_item.qty)))
+		.where(
+			(purchase_receipt_item.purchase_receipt_item.isin(items))
+			& (purchase_receipt.docstatus == 1)
+			& (purchase_receipt.is_return == 1)
 		)
+		.groupby(purchase_receipt_item.purchase_receipt_item)
 	)
 
+	return frappe._dict(query.run())
+
 
 @frappe.whitelist()
 def make_purchase_invoice(source_name, target_doc=None):
 	from erpnext.accounts.party import get_payment_terms_template
 
 	doc = frappe.get_doc("Purchase Receipt", source_name)
-	returned_qty_map = get_returned_qty_map(source_name)
-	invoiced_qty_map = get_invoiced_qty_map(source_name)
+	invoiced_qty_map, returned_qty_map = get_invoiced_and_returned_qty_map(source_name)
+	bill_for_rejected_quantity_in_purchase_invoice = frappe.db.get_single_value(
+		"Buying Settings", "bill_for_rejected_quantity_in_purchase_invoice", cache=True
+	)
 
 	def set_missing_values(source, target):
 		if len(target.get("items")) == 0:
 			frappe.throw(_("All items have already been Invoiced/Returned"))
 
-		doc = frappe.get_doc(target)
-		doc.payment_terms_template = get_payment_terms_template(
+		target.payment_terms_template = get_payment_terms_template(
 			source.supplier, "Supplier", source.company
 		)
-		doc.run_method("onload")
-		doc.run_method("set_missing_values")
-		doc.run_method("calculate_taxes_and_totals")
-		doc.set_payment_schedule()
+		target.run_method("onload")
+		target.run_method("set_missing_values")
+		target.run_method("calculate_taxes_and_totals")
+		target.set_payment_schedule()
 
 	def update_item(source_doc, target_doc, source_parent):
 		target_doc.qty, returned_qty = get_pending_qty(source_doc)
-		if frappe.db.get_single_value(
-			"Buying Settings", "bill_for_rejected_quantity_in_purchase_invoice"
-		):
+		if bill_for_rejected_quantity_in_purchase_invoice:
 			target_doc.rejected_qty = 0
 		target_doc.stock_qty = flt(target_doc.qty) * flt(
 			target_doc.conversion_factor, target_doc.precision("conversion_factor")
 		)
 		returned_qty_map[source_doc.name] = returned_qty
 
+	pending_qty_map = {}
+
 	def get_pending_qty(item_row):
+		# evaluated by both the row filter and update_item, compute it once per row
+		if item_row.name not in pending_qty_map:
+			pending_qty_map[item_row.name] = _get_pending_qty(item_row)
+
+		return pending_qty_map[item_row.name]
+
+	def _get_pending_qty(item_row):
 		qty = item_row.qty
-		if frappe.db.get_single_value(
-			"Buying Settings", "bill_for_rejected_quantity_in_purchase_invoice"
-		):
+		if bill_for_rejected_quantity_in_purchase_invoice:
 			qty = item_row.received_qty
 		pending_qty = qty - invoiced_qty_map.get(item_row.name, 0)
 		returned_qty = flt(returned_qty_map.get(item_row.name, 0))
@@ -1103,38 +1236,30 @@ def make_purchase_invoice(source_name, target_doc=None):
 	return doclist
 
 
-def get_invoiced_qty_map(purchase_receipt):
-	"""returns a map: {pr_detail: invoiced_qty}"""
-	invoiced_qty_map = {}
-
-	for pr_detail, qty in frappe.db.sql(
-		"""select pr_detail, qty from `tabPurchase Invoice Item`
-		where purchase_receipt=%s and docstatus=1""",
-		purchase_receipt,
-	):
-		if not invoiced_qty_map.get(pr_detail):
-			invoiced_qty_map[pr_detail] = 0
-		invoiced_qty_map[pr_detail] += qty
-
-	return invoiced_qty_map
-
+def get_invoiced_and_returned_qty_map(purchase_receipt):
+	"""returns two maps in one round trip: {pr_detail: invoiced_qty}, {pr_detail: returned_qty}"""
+	invoiced_qty_map, returned_qty_map = {}, frappe._dict()
+	qty_maps = {"invoiced": invoiced_qty_map, "returned": returned_qty_map}
 
-def get_returned_qty_map(purchase_receipt):
-	"""returns a map: {so_detail: returned_qty}"""
-	returned_qty_map = frappe._dict(
-		frappe.db.sql(
-			"""select pr_item.purchase_receipt_item, abs(pr_item.qty) as qty
+	for qty_type, row_name, qty in frappe.db.sql(
+		"""select 'invoiced' as qty_type, pr_detail as row_name, sum(qty) as qty
+		from `tabPurchase Invoice Item`
+		where purchase_receipt = %(purchase_receipt)s and docstatus = 1
+		group by pr_detail
+		union all
+		select 'returned' as qty_type, pr_item.purchase_receipt_item as row_name, sum(abs(pr_item.qty)) as qty
 		from `tabPurchase Receipt Item` pr_item, `tabPurchase Receipt` pr
 		where pr.name = pr_item.parent
 			and pr.docstatus = 1
 			and pr.is_return = 1
-			and pr.return_against = %s
+			and pr.return_against = %(purchase_receipt)s
+		group by pr_item.purchase_receipt_item
 	""",
-			purchase_receipt,
-		)
-	)
+		{"purchase_receipt": purchase_receipt},
+	):
+		qty_maps[qty_type][row_name] = qty
 
-	return returned_qty_map
+	return invoiced_qty_map, returned_qty_map
 
 
 @frappe.whitelist()
@@ -1202,51 +1327,76 @@ def get_item_account_wise_additional_cost(purchase_document):
 	if not landed_cost_vouchers:
 		return
 
-	item_account_wise_cost = {}
+	lcv_names = list({lcv.parent for lcv in landed_cost_vouchers})
+	distribute_charges_based_on = dict(
+		frappe.get_all(
+			"Landed Cost Voucher",
+			filters={"name": ["in", lcv_names]},
+			fields=["name", "distribute_charges_based_on"],
+			as_list=1,
+		)
+	)
+
+	lcv_items = {}
+	for item in frappe.get_all(
+		"Landed Cost Item",
+		filters={"parent": ["in", lcv_names], "parenttype": "Landed Cost Voucher"},
+		fields=[
+			"parent",
+			"item_code",
+			"receipt_document",
+			"purchase_receipt_item",
+			"qty",
+			"amount",
+			"applicable_charges",
+		],
+		order_by="idx",
+	):
+		lcv_items.setdefault(item.parent, []).append(item)
+
+	lcv_taxes = {}
+	for tax in frappe.get_all(
+		"Landed Cost Taxes and Charges",
+		filters={"parent": ["in", lcv_names], "parenttype": "Landed Cost Voucher"},
+		fields=["parent", "expense_account", "amount", "base_amount"],
+		order_by="idx",
+	):
+		lcv_taxes.setdefault(tax.parent, []).append(tax)
+
+	item_account_wise_cost = defaultdict(
+		lambda: defaultdict(lambda: {"amount": 0.0, "base_amount": 0.0})
+	)
 
 	for lcv in landed_cost_vouchers:
-		landed_cost_voucher_doc = frappe.get_doc("Landed Cost Voucher", lcv.parent)
+		items = lcv_items.get(lcv.parent, [])
+		taxes = lcv_taxes.get(lcv.parent, [])
 
 		# Use amount field for total item cost for manually cost distributed LCVs
-		if landed_cost_voucher_doc.distribute_charges_based_on == "Distribute Manually":
+		if distribute_charges_based_on.get(lcv.parent) == "Distribute Manually":
 			based_on_field = "amount"
 		else:
-			based_on_field = frappe.scrub(landed_cost_voucher_doc.distribute_charges_based_on)
-
-		total_item_cost = 0
+			based_on_field = frappe.scrub(distribute_charges_based_on.get(lcv.parent))
 
-		for item in landed_cost_voucher_doc.items:
-			total_item_cost += item.get(based_on_field)
+		total_item_cost = sum(item.get(based_on_field) for item in items)
 
-		for item in landed_cost_voucher_doc.items:
-			if item.receipt_document == purchase_document:
-				for account in landed_cost_voucher_doc.taxes:
-					item_account_wise_cost.setdefault((item.item_code, item.purchase_receipt_item), {})
-					item_account_wise_cost[(item.item_code, item.purchase_receipt_item)].setdefault(
-						account.expense_account, {"amount": 0.0, "base_amount": 0.0}
-					)
+		for item in items:
+			if item.receipt_document == purchase_document and taxes:
+				# share of this item in every charge of the voucher
+				weight = item.get(based_on_field) / total_item_cost if total_item_cost > 0 else None
+				item_cost = item_account_wise_cost[(item.item_code, item.purchase_receipt_item)]
 
-					if total_item_cost > 0:
-						item_account_wise_cost[(item.item_code, item.purchase_receipt_item)][
-							account.expense_account
-						]["amount"] += (
-							account.amount * item.get(based_on_field) / total_item_cost
-						)
+				for account in taxes:
+					account_cost = item_cost[account.expense_account]
 
-						item_account_wise_cost[(item.item_code, item.purchase_receipt_item)][
-							account.expense_account
-						]["base_amount"] += (
-							account.base_amount * item.get(based_on_field) / total_item_cost
-						)
+					if weight is not None:
+						account_cost["amount"] += account.amount * weight
+						account_cost["base_amount"] += account.base_amount * weight
 					else:
-						item_account_wise_cost[(item.item_code, item.purchase_receipt_item)][
-							account.expense_account
-						]["amount"] += item.applicable_charges
-						item_account_wise_cost[(item.item_code, item.purchase_receipt_item)][
-							account.expense_account
-						]["base_amount"] += item.applicable_charges
-
-	return item_account_wise_cost
+						account_cost["amount"] += item.applicable_charges
+						account_cost["base_amount"] += item.applicable_charges
+
+	# Plain dicts, so callers cannot add keys by looking them up
+	return {key: dict(account_cost) for key, account_cost in item_account_wise_cost.items()}
 
 
 def on_doctype_update():
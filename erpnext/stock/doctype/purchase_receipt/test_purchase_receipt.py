@@ -957,6 +957,28 @@ class TestPurchaseReceipt(FrappeTestCase):
 		pr1.reload()
 		pr1.cancel()
 
+	def test_make_purchase_invoice_from_pr_with_multiple_returns_against_same_row(self):
+		pr = make_purchase_receipt(qty=10)
+
+		returns = []
+		for qty in (-2, -3):
+			pr_return = make_purchase_receipt(
+				qty=qty, is_return=1, return_against=pr.name, do_not_submit=True
+			)
+			pr_return.items[0].purchase_receipt_item = pr.items[0].name
+			pr_return.submit()
+			returns.append(pr_return)
+
+		# pending qty is reduced by both returns, not only the last one
+		pi = make_purchase_invoice(pr.name)
+		self.assertEqual(pi.items[0].qty, 5)
+
+		for pr_return in reversed(returns):
+			pr_return.cancel()
+
+		pr.reload()
+		pr.cancel()
+
 	def test_stock_transfer_from_purchase_receipt(self):
 		pr1 = make_purchase_receipt(
 			warehouse="Work In Progress - TCP1", company="_Test Company with perpetual inventory"
@@ -2017,6 +2039,87 @@ class TestPurchaseReceipt(FrappeTestCase):
 		ste7.reload()
 		self.assertEqual(ste7.items[0].valuation_rate, valuation_rate)
 
+	def test_cancel_purchase_receipt_with_submitted_purchase_invoice(self):
+		pr = make_purchase_receipt()
+		pi = make_purchase_invoice(pr.name)
+		pi.submit()
+
+		pr.load_from_db()
+		with self.assertRaises(frappe.ValidationError) as err:
+			pr.check_next_docstatus()
+
+		self.assertIn(
+			frappe._("Purchase Invoice {0} is already submitted").format(pi.name), str(err.exception)
+		)
+
+		pi.cancel()
+		pr.reload()
+		pr.cancel()
+
+	def test_no_accounting_entries_notice_for_rejected_warehouse(self):
+		from erpnext.stock.doctype.warehouse.test_warehouse import get_warehouse
+
+		rejected_warehouse = "_Test Rejected Warehouse - TCP1"
+		if not frappe.db.exists("Warehouse", rejected_warehouse):
+			get_warehouse(
+				company="_Test Company with perpetual inventory",
+				abbr=" - TCP1",
+				warehouse_name="_Test Rejected Warehouse",
+			).name
+
+		pr = make_purchase_receipt(
+			company="_Test Company with perpetual inventory",
+			warehouse="Stores - TCP1",
+			qty=3,
+			rejected_qty=2,
+			rejected_warehouse=rejected_warehouse,
+		)
+
+		# neither warehouse has an account in the map passed in
+		frappe.clear_messages()
+		pr.make_item_gl_entries([], warehouse_account={})
+
+		expected = "\n".join(sorted([pr.items[0].warehouse, rejected_warehouse]))
+		messages = [cstr(d.get("message")) for d in frappe.get_message_log()]
+		self.assertTrue(any(expected in message for message in messages))
+
+		pr.cancel()
+
+	def test_per_billed_with_and_without_incoming_rate_adjustment(self):
+		per_billed = {}
+		for adjust_incoming_rate in (0, 1):
+			frappe.db.set_single_value(
+				"Buying Settings", "set_landed_cost_based_on_purchase_invoice_rate", adjust_incoming_rate
+			)
+
+			pr = make_purchase_receipt(qty=10, rate=50)
+
+			pr_return = make_purchase_receipt(
+				qty=-2, rate=50, is_return=1, return_against=pr.name, do_not_submit=True
+			)
+			pr_return.items[0].purchase_receipt_item = pr.items[0].name
+			pr_return.submit()
+
+			pi = make_purchase_invoice(pr.name)
+			pi.items[0].qty = 4
+			pi.submit()
+
+			pr.load_from_db()
+			per_billed[adjust_incoming_rate] = pr.per_billed
+
+			pi.cancel()
+			pr_return.cancel()
+			pr.reload()
+			pr.cancel()
+
+		frappe.db.set_single_value(
+			"Buying Settings", "set_landed_cost_based_on_purchase_invoice_rate", 0
+		)
+
+		# 4 * 50 billed against (10 - 2) * 50 pending, on both code paths
+		self.assertEqual(per_billed[0], 50)
+		self.assertEqual(per_billed[1], per_billed[0])
+
 
 def prepare_data_for_internal_transfer():
 	from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_internal_supplier